@@ -73,14 +73,14 @@ def debug_tx(tx_hash: str) -> Union[dict, None]:
         return None
 
 
-async def debug_tx_async(session: aiohttp.ClientSession, tx_hash: str) -> Tuple[Union[dict, None], str]:
+async def debug_tx_async(session: aiohttp.ClientSession, tx_hash: str, disable_stack: bool = True) -> Tuple[Union[dict, None], str]:
     try:
         url = f"{ARCHIVE_GETH_URL}"
         body = {
             "jsonrpc": "2.0",
             "id": 5,
             "method": "debug_traceTransaction",
-            "params": [tx_hash, {"disableStack": True, "disableMemory": True, "disableStorage": True}]
+            "params": [tx_hash, {"disableStack": disable_stack, "disableMemory": True, "disableStorage": True}]
         }
 
         async with session.post(url=url, json=body) as response:
@@ -90,14 +90,18 @@ async def debug_tx_async(session: aiohttp.ClientSession, tx_hash: str) -> Tuple[
         return None, tx_hash
 
 
-async def get_tx_receipt_async(session: aiohttp.ClientSession, tx_hash: str):
+async def get_block_receipts_async(session: aiohttp.ClientSession, block_num: Union[int, str]) -> Union[List[dict], None]:
+    """Return the receipts of all txs in the block, or None if the node does not support eth_getBlockReceipts."""
     try:
+        if isinstance(block_num, int):
+            block_num = hex(block_num)
+
         url = f"{INFURA_GETH_URL}"
         body = {
             "jsonrpc": "2.0",
-            "id": 4,
-            "method": "eth_getTransactionReceipt",
-            "params": [tx_hash]
+            "id": 1,
+            "method": "eth_getBlockReceipts",
+            "params": [block_num]
         }
         async with session.post(url=url, json=body) as response:
             data = await response.json()
@@ -4,12 +4,14 @@ import os.path
 import aiohttp
 import asyncio
 import api.eth_requests as eth_requests
-from src import stats, trace_logs, visualisations, tx_processing, utils
-from typing import Tuple, List
+from src import stats, trace_logs, visualisations, tx_processing, utils, parquet_io, spill
+from typing import Tuple, List, Union
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
+NGRAM_SIZE = 3
+
 
 def get_last_x_block_nums(x: int) -> Tuple[int, int]:
     latest_block = eth_requests.make_call('eth_blockNumber')
@@ -27,9 +29,22 @@ def write_tx_hashes(start_block: int, end_block: int, tx_hashes: dict):
         f.write(json.dumps(tx_hashes))
 
 
-def write_opcodes(start_block: int, end_block: int, opcodes: dict):
-    with open(f"./{start_block}_{end_block}/tx_opcode_stats.json", "w") as f:
-        f.write(json.dumps(opcodes))
+def write_tx_contracts(start_block: int, end_block: int, tx_contracts: dict):
+    with open(f"./{start_block}_{end_block}/tx_contracts.json", "w") as f:
+        f.write(json.dumps(tx_contracts))
+
+
+def write_trace_data(start_block: int, end_block: int, data_type: utils.TraceDataType, data: Union[dict, spill.SpilledTxData]):
+    spill.write_tx_data(f"./{start_block}_{end_block}/{utils.TRACE_DATA_FILES[data_type]}", data)
+
+    # The persisted contract profiles are made from the contract opcodes, drop them so they are rebuilt.
+    contract_profiles_path = f"./{start_block}_{end_block}/contract_profiles.json"
+    if data_type == utils.TraceDataType.CONTRACT_OPCODES and os.path.isfile(contract_profiles_path):
+        os.remove(contract_profiles_path)
+
+
+def write_opcodes(start_block: int, end_block: int, opcodes: Union[dict, spill.SpilledTxData]):
+    write_trace_data(start_block, end_block, utils.TraceDataType.OPCODES, opcodes)
 
 
 def read_tx_hashes(start_block: int, end_block: int):
@@ -37,11 +52,25 @@ def read_tx_hashes(start_block: int, end_block: int):
         return json.loads(f.read())
 
 
-def read_opcodes(start_block: int, end_block: int):
-    with open(f"./{start_block}_{end_block}/tx_opcode_stats.json", "r") as f:
+def read_tx_contracts(start_block: int, end_block: int):
+    tx_contracts_path = f"./{start_block}_{end_block}/tx_contracts.json"
+    if not os.path.isfile(tx_contracts_path):
+        return None
+
+    with open(tx_contracts_path, "r") as f:
         return json.loads(f.read())
 
 
+def read_trace_data(start_block: int, end_block: int, data_type: utils.TraceDataType) -> Union[dict, spill.SpilledTxData, None]:
+    """Read the per tx data of a window. Spilled windows are not loaded in memory but streamed from disk by the stats."""
+
+    return spill.read_tx_data(f"./{start_block}_{end_block}/{utils.TRACE_DATA_FILES[data_type]}")
+
+
+def read_opcodes(start_block: int, end_block: int):
+    return read_trace_data(start_block, end_block, utils.TraceDataType.OPCODES)
+
+
 def read_all_opcodes(blocks: List[Tuple[int, int]]):
     logs = dict()
     for start_block, end_block in blocks:
@@ -50,6 +79,16 @@ def read_all_opcodes(blocks: List[Tuple[int, int]]):
     return logs
 
 
+def read_all_trace_data(blocks: List[Tuple[int, int]], data_type: utils.TraceDataType):
+    logs = dict()
+    for start_block, end_block in blocks:
+        data = read_trace_data(start_block, end_block, data_type)
+        if data is not None:
+            logs[(start_block, end_block)] = data
+
+    return logs
+
+
 def init(blocks: List[Tuple[int, int]]):
     for start_block, end_block in blocks:
         dir_path = f"./{start_block}_{end_block}"
@@ -73,17 +112,42 @@ def test():
 async def fetch_blocks_tx_hashes(session: aiohttp.ClientSession, blocks: List[Tuple[int, int]]):
 
     for start_block, end_block in blocks:
-        tx_hashes = await tx_processing.get_block_txs(session, start_block, end_block)
+        tx_hashes, tx_contracts = await tx_processing.get_block_txs(session, start_block, end_block)
         write_tx_hashes(start_block, end_block, tx_hashes)
+        write_tx_contracts(start_block, end_block, tx_contracts)
 
 
-async def fetch_blocks_debug_logs(session: aiohttp.ClientSession, blocks: List[Tuple[int, int]]):
+async def fetch_blocks_debug_logs(session: aiohttp.ClientSession, blocks: List[Tuple[int, int]], ngram_size: int = NGRAM_SIZE, call_frames: bool = False, memory_budget: int = spill.MEMORY_BUDGET):
 
     for start_block, end_block in blocks:
         tx_hashes = read_tx_hashes(start_block, end_block)
-        opcodes = await trace_logs.get_opcodes_for_tx_hashes(session, tx_hashes)
-        write_opcodes(start_block, end_block, opcodes)
+        tx_contracts = read_tx_contracts(start_block, end_block)
+        trace_data = await trace_logs.get_trace_stats_for_tx_hashes(session, tx_hashes, ngram_size, tx_contracts, call_frames, memory_budget, f"./{start_block}_{end_block}")
+        for data_type, data in trace_data.items():
+            write_trace_data(start_block, end_block, data_type, data)
+
+
+
+def export_blocks_opcodes(blocks: List[Tuple[int, int]]):
+
+    for start_block, end_block in blocks:
+        tx_gas = read_trace_data(start_block, end_block, utils.TraceDataType.OPCODE_GAS)
+        parquet_io.export_tx_opcodes(start_block, end_block, read_opcodes(start_block, end_block), tx_gas)
+
+
+def make_blocks_stats(blocks: List[Tuple[int, int]]):
+    """Make the stats of the windows one at a time, so only the trace data of a single window is read in memory."""
+
+    block_stats = dict()
+    for start_block, end_block in blocks:
+        window = [(start_block, end_block)]
+        logs = read_all_opcodes(window)
+        ngram_logs = read_all_trace_data(window, utils.TraceDataType.OPCODE_NGRAMS)
+        gas_logs = read_all_trace_data(window, utils.TraceDataType.OPCODE_GAS)
+        contract_logs = read_all_trace_data(window, utils.TraceDataType.CONTRACT_OPCODES)
+        block_stats.update(stats.make_stats(logs, ngram_logs, gas_logs, contract_logs))
 
+    return block_stats
 
 
 async def main(fetch_block_data=False):
@@ -109,12 +173,13 @@ async def main(fetch_block_data=False):
             logging.debug("Block tx hashes fetched.")
             await fetch_blocks_debug_logs(session, blocks)
             logging.debug("Block debug logs obtained.")
+            export_blocks_opcodes(blocks)
+            logging.debug("Block opcodes exported to parquet.")
         else:
             with open(f'./{latest_block}.json', 'r') as f:
                 blocks = json.loads(f.read())
 
-        logs = read_all_opcodes(blocks)
-        block_stats = stats.make_stats(logs)
+        block_stats = make_blocks_stats(blocks)
         visualisations.make_visualisations(block_stats)
 
         # block_stat_key = list(block_stats.keys())[0]
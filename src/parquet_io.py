@@ -0,0 +1,137 @@
+import os
+import logging
+from typing import Dict, Union, List, Iterator
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+logging.basicConfig(level=logging.INFO)
+
+PARQUET_PATH = './parquet/tx_opcodes'
+# Rows are sorted by block, so small row groups let block filters skip most of a file.
+ROW_GROUP_SIZE = 64 * 1024
+# Every partition is written with this schema, so the dataset doesn't depend on the schema of the first partition.
+# gas is null for the windows traced without it.
+TX_OPCODES_SCHEMA = pa.schema([
+    pa.field('block', pa.int64(), nullable=False),
+    pa.field('tx_hash', pa.dictionary(pa.int32(), pa.string()), nullable=False),
+    pa.field('opcode', pa.dictionary(pa.int32(), pa.string()), nullable=False),
+    pa.field('count', pa.int64(), nullable=False),
+    pa.field('gas', pa.int64(), nullable=True),
+])
+
+
+def tx_opcodes_to_table(tx_opcodes: Dict[int, Dict[str, Dict[str, int]]], tx_gas: Union[Dict[int, Dict[str, List[int]]], None] = None) -> pa.Table:
+    """Return the per tx opcode counts and gas (aligned with the opcodes of each tx, null where tx_gas has none)
+    as a long Arrow table with the TX_OPCODES_SCHEMA columns: block, tx_hash, opcode, count, gas."""
+
+    return pa.Table.from_batches(list(get_tx_opcodes_batches(tx_opcodes, tx_gas)), schema=TX_OPCODES_SCHEMA)
+
+
+def get_tx_opcodes_batches(tx_opcodes: Dict[int, Dict[str, Dict[str, int]]], tx_gas: Union[Dict[int, Dict[str, List[int]]], None] = None, batch_size: int = ROW_GROUP_SIZE) -> Iterator[pa.RecordBatch]:
+    """Yield the rows of tx_opcodes_to_table in block order, as record batches of up to batch_size rows.
+    Blocks are read one at a time, so spilled tx data is never loaded in memory as a whole."""
+
+    blocks, tx_hashes, opcodes, counts, gas = [], [], [], [], []
+
+    for block_num in sorted(tx_opcodes.keys(), key=int):
+        block_data = tx_opcodes.get(block_num)
+        block_gas = tx_gas.get(block_num, dict()) if tx_gas is not None else dict()
+        for tx_hash, tx_data in block_data.items():
+            tx_opcodes_gas = block_gas.get(tx_hash, [])
+            for i, (opcode, count) in enumerate(tx_data.items()):
+                blocks.append(int(block_num))
+                tx_hashes.append(tx_hash)
+                opcodes.append(opcode)
+                counts.append(count)
+                gas.append(tx_opcodes_gas[i] if i < len(tx_opcodes_gas) else None)
+
+        if len(blocks) >= batch_size:
+            yield pa.RecordBatch.from_arrays([blocks, tx_hashes, opcodes, counts, gas], schema=TX_OPCODES_SCHEMA)
+            blocks, tx_hashes, opcodes, counts, gas = [], [], [], [], []
+
+    if blocks:
+        yield pa.RecordBatch.from_arrays([blocks, tx_hashes, opcodes, counts, gas], schema=TX_OPCODES_SCHEMA)
+
+
+def export_tx_opcodes(start_block: int, end_block: int, tx_opcodes: dict, tx_gas: Union[dict, None] = None, root_path: str = PARQUET_PATH):
+    """Write the per tx opcode data of the [start_block, end_block) window to its own block_range partition.
+    The rows are streamed to the file in batches of ROW_GROUP_SIZE rows, so a spilled window is never fully in memory."""
+
+    partition_path = f"{root_path}/block_range={start_block}_{end_block}"
+    os.makedirs(partition_path, exist_ok=True)
+    with pq.ParquetWriter(f"{partition_path}/tx_opcodes.parquet", TX_OPCODES_SCHEMA) as writer:
+        for batch in get_tx_opcodes_batches(tx_opcodes, tx_gas):
+            writer.write_batch(batch, row_group_size=ROW_GROUP_SIZE)
+    logging.debug(f"Tx opcodes for blocks: {start_block} - {end_block} exported to {partition_path}.")
+
+
+def get_partition_paths(root_path: str = PARQUET_PATH, start_block: Union[int, None] = None, end_block: Union[int, None] = None) -> List[str]:
+    """Return the files of the block_range partitions that overlap [start_block, end_block)."""
+
+    paths = []
+    if not os.path.isdir(root_path):
+        return paths
+
+    for partition in sorted(os.listdir(root_path)):
+        if not partition.startswith('block_range='):
+            continue
+
+        partition_start, partition_end = [int(block_num) for block_num in partition[len('block_range='):].split('_')]
+        if start_block is not None and partition_end <= start_block:
+            continue
+        if end_block is not None and partition_start >= end_block:
+            continue
+
+        paths.append(f"{root_path}/{partition}/tx_opcodes.parquet")
+
+    return paths
+
+
+def read_tx_opcodes_table(root_path: str = PARQUET_PATH, start_block: Union[int, None] = None, end_block: Union[int, None] = None, columns: Union[List[str], None] = None) -> pa.Table:
+    """Read the exported tx opcodes in [start_block, end_block) as an Arrow table.
+    Only the partitions overlapping the range are opened, only the requested columns are read and
+    the block filter is pushed down to the parquet row groups."""
+
+    paths = get_partition_paths(root_path, start_block, end_block)
+    if not paths:
+        empty_table = TX_OPCODES_SCHEMA.empty_table()
+        return empty_table.select(columns) if columns else empty_table
+
+    block_filter = None
+    if start_block is not None:
+        block_filter = ds.field('block') >= start_block
+    if end_block is not None:
+        end_filter = ds.field('block') < end_block
+        block_filter = end_filter if block_filter is None else block_filter & end_filter
+
+    return ds.dataset(paths, schema=TX_OPCODES_SCHEMA, format='parquet').to_table(columns=columns, filter=block_filter)
+
+
+def read_tx_opcodes(root_path: str = PARQUET_PATH, start_block: Union[int, None] = None, end_block: Union[int, None] = None, value: str = 'count') -> Dict[int, Dict[str, Dict[str, int]]]:
+    """Read the exported tx opcodes back into the {block: {tx_hash: {opcode: value}}} dict used by the stats functions.
+    value is the column to read: 'count' for opcode counts or 'gas' for opcode gas (None where it wasn't exported)."""
+
+    table = read_tx_opcodes_table(root_path, start_block, end_block, ['block', 'tx_hash', 'opcode', value])
+
+    tx_opcodes: Dict[int, Dict[str, Dict[str, int]]] = dict()
+    for block_num, tx_hash, opcode, opcode_value in zip(*[table.column(name).to_pylist() for name in ['block', 'tx_hash', 'opcode', value]]):
+        tx_opcodes.setdefault(block_num, dict()).setdefault(tx_hash, dict())[opcode] = opcode_value
+
+    return tx_opcodes
+
+
+def read_tx_opcodes_frame(root_path: str = PARQUET_PATH, start_block: Union[int, None] = None, end_block: Union[int, None] = None, columns: Union[List[str], None] = None, wide: bool = False):
+    """Read the exported tx opcodes as a pandas DataFrame (opcode and tx_hash become categoricals).
+    With wide=True the counts are pivoted to one row per (block, tx_hash) and one column per opcode."""
+
+    if wide and columns is not None:
+        columns = list(dict.fromkeys(['block', 'tx_hash', 'opcode', 'count'] + columns))
+
+    frame = read_tx_opcodes_table(root_path, start_block, end_block, columns).to_pandas()
+
+    if wide:
+        frame = frame.pivot_table(index=['block', 'tx_hash'], columns='opcode', values='count', aggfunc='sum', fill_value=0, observed=True).astype(int)
+
+    return frame
@@ -0,0 +1,344 @@
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Union, Tuple, List
+
+from aiohttp import web
+
+from . import stats
+from .spill import read_tx_data
+from .utils import StatsType, TraceDataType, TRACE_DATA_FILES
+
+logging.basicConfig(level=logging.INFO)
+
+HOST = '127.0.0.1'
+PORT = 8080
+LATEST_BLOCK = 12_926_310
+# Max number of computed aggregates kept in the LRU cache.
+CACHE_SIZE = 256
+
+
+class StatsStore:
+    """Keeps the per tx trace data of the loaded block windows in memory and
+    caches the aggregates computed over block ranges, keyed by (start_block, end_block, stats type)."""
+
+    def __init__(self, cache_size: int = CACHE_SIZE):
+        self.windows: List[Tuple[int, int]] = []
+        self.blocks: Dict[TraceDataType, Dict[int, dict]] = {data_type: dict() for data_type in TRACE_DATA_FILES.keys()}
+        # Contract stats persisted for each window, so full windows are not rescanned.
+        self.contract_stats: Dict[Tuple[int, int], dict] = dict()
+        self.cache: OrderedDict = OrderedDict()
+        self.cache_size = cache_size
+        # Bumped on every window (re)load, so aggregates computed from the replaced data are not cached.
+        self.version = 0
+
+    def load_window(self, start_block: int, end_block: int) -> bool:
+        """(Re)load the trace data of the [start_block, end_block) window from its dir.
+        Returns False, leaving the store unchanged, if the window has no trace data."""
+
+        window_data = read_window(start_block, end_block)
+        if window_data is None:
+            return False
+
+        self.add_window(start_block, end_block, *window_data)
+        return True
+
+    def add_window(self, start_block: int, end_block: int, blocks: Dict[TraceDataType, Dict[int, dict]], contract_stats: Union[dict, None]):
+        """Replace the data of the window with the data read by read_window and
+        drop the cached aggregates of the ranges that overlap the window.
+        New block dicts are swapped in, so the aggregates being computed in the executor keep reading the old ones."""
+
+        for data_type, store_blocks in list(self.blocks.items()):
+            new_blocks = {block_num: block_data for block_num, block_data in store_blocks.items() if not start_block <= block_num < end_block}
+            new_blocks.update(blocks.get(data_type, dict()))
+            self.blocks[data_type] = new_blocks
+        self.version += 1
+
+        if contract_stats is not None:
+            self.contract_stats[(start_block, end_block)] = contract_stats
+        else:
+            self.contract_stats.pop((start_block, end_block), None)
+
+        if (start_block, end_block) not in self.windows:
+            self.windows.append((start_block, end_block))
+            self.windows.sort()
+
+        self.invalidate(start_block, end_block)
+        logging.debug(f"Window {start_block} - {end_block} loaded.")
+
+    def invalidate(self, start_block: int, end_block: int):
+        for key in list(self.cache.keys()):
+            range_start, range_end, _ = key
+            if range_start < end_block and start_block < range_end:
+                del self.cache[key]
+
+    def get_range(self, start_block: Union[int, None], end_block: Union[int, None]) -> Tuple[int, int]:
+        """Fill in the missing range bounds with the bounds of the loaded windows."""
+
+        if start_block is None:
+            start_block = self.windows[0][0] if self.windows else 0
+        if end_block is None:
+            end_block = self.windows[-1][1] if self.windows else 0
+
+        return start_block, end_block
+
+    def select(self, data_type: TraceDataType, start_block: int, end_block: int) -> Dict[int, dict]:
+        return stats.filter_tx_opcodes(self.blocks[data_type], start_block, end_block)
+
+    async def get_cached(self, key: Tuple[int, int, str], compute):
+        """Return the cached aggregate, or compute it in an executor so the other requests are served meanwhile."""
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        version = self.version
+        value = await asyncio.get_running_loop().run_in_executor(None, compute)
+        if version == self.version:
+            self.cache[key] = value
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return value
+
+    async def get_stats(self, stats_type: StatsType, start_block: int, end_block: int) -> dict:
+        return await self.get_cached((start_block, end_block, stats_type.value), lambda: self.compute_stats(stats_type, start_block, end_block))
+
+    def get_dependency(self, stats_type: StatsType, start_block: int, end_block: int) -> dict:
+        """Return the stats another aggregate is computed from. Runs in the executor, so the cache is only read."""
+
+        value = self.cache.get((start_block, end_block, stats_type.value))
+        return value if value is not None else self.compute_stats(stats_type, start_block, end_block)
+
+    def compute_stats(self, stats_type: StatsType, start_block: int, end_block: int) -> dict:
+        if stats_type == StatsType.OPCODES_PER_BLOCK:
+            return stats.get_num_opcodes_per_block(self.select(TraceDataType.OPCODES, start_block, end_block))
+        elif stats_type == StatsType.TOTAL_AMOUNT_OPCODES:
+            return stats.get_total_amount_of_opcodes_per_block(self.select(TraceDataType.OPCODES, start_block, end_block))
+        elif stats_type == StatsType.OPCODE_COUNTS:
+            return stats.get_opcode_counts(self.select(TraceDataType.OPCODES, start_block, end_block))
+        elif stats_type == StatsType.OPCODE_STATS:
+            return stats.get_opcode_stats(self.select(TraceDataType.OPCODES, start_block, end_block))
+        elif stats_type == StatsType.OPCODE_BLOCK_FREQUENCY:
+            return stats.get_opcode_block_frequencies(self.get_dependency(StatsType.OPCODE_STATS, start_block, end_block))
+        elif stats_type == StatsType.OPCODE_NGRAMS:
+            return stats.get_top_ngrams(stats.get_opcode_ngram_counts(self.select(TraceDataType.OPCODE_NGRAMS, start_block, end_block)))
+        elif stats_type == StatsType.OPCODE_GAS:
+            return stats.get_opcode_gas(self.select(TraceDataType.OPCODES, start_block, end_block), self.blocks[TraceDataType.OPCODE_GAS])
+        elif stats_type == StatsType.OPCODE_GAS_STATS:
+            opcode_gas = self.get_dependency(StatsType.OPCODE_GAS, start_block, end_block)
+            opcode_counts = self.get_dependency(StatsType.OPCODE_COUNTS, start_block, end_block)
+            return stats.get_opcode_gas_stats(opcode_gas, opcode_counts)
+        elif stats_type == StatsType.CONTRACT_PROFILES:
+            contract_profiles = stats.merge_contract_profiles(self.get_contract_profiles(start_block, end_block))
+            return {
+                'contracts': contract_profiles,
+                'index': stats.get_contract_opcode_index(contract_profiles),
+            }
+
+    def get_contract_profiles(self, start_block: int, end_block: int) -> List[Dict[str, dict]]:
+        """Return the contract profiles of every window overlapping the range. Windows fully inside the range use
+        their persisted profiles, only the windows that partially overlap it (or have none) are rescanned."""
+
+        contract_profiles = []
+        for window_start, window_end in list(self.windows):
+            if window_end <= start_block or end_block <= window_start:
+                continue
+
+            contract_stats = self.contract_stats.get((window_start, window_end))
+            if start_block <= window_start and window_end <= end_block and contract_stats is not None:
+                contract_profiles.append(contract_stats['contracts'])
+            else:
+                contract_profiles.append(stats.get_contract_profiles(self.select(TraceDataType.CONTRACT_OPCODES, max(start_block, window_start), min(end_block, window_end))))
+
+        return contract_profiles
+
+    async def get_opcode(self, opcode: str, start_block: int, end_block: int) -> dict:
+        return await self.get_cached((start_block, end_block, f"OPCODE:{opcode}"), lambda: self.compute_opcode(opcode, start_block, end_block))
+
+    def compute_opcode(self, opcode: str, start_block: int, end_block: int) -> dict:
+        """Return the per block counts of the opcode and its total count and gas in the range."""
+
+        tx_opcodes = self.select(TraceDataType.OPCODES, start_block, end_block)
+
+        blocks: Dict[int, int] = dict()
+        for block_num, block_data in tx_opcodes.items():
+            blocks[block_num] = sum(tx_data.get(opcode, 0) for tx_data in block_data.values())
+
+        gas = stats.get_opcode_gas(tx_opcodes, self.blocks[TraceDataType.OPCODE_GAS]).get(opcode, 0)
+
+        return {
+            'opcode': opcode,
+            'count': sum(blocks.values()),
+            'gas': gas,
+            'blocks': dict(sorted(blocks.items())),
+        }
+
+
+def read_window(start_block: int, end_block: int) -> Union[Tuple[Dict[TraceDataType, Dict[int, dict]], Union[dict, None]], None]:
+    """Read the per tx trace data and the persisted contract stats of a window dir, None if it has no trace data.
+    Doesn't touch the store, so it can run in an executor."""
+
+    dir_path = f"./{start_block}_{end_block}"
+    blocks: Dict[TraceDataType, Dict[int, dict]] = dict()
+    for data_type, file_name in TRACE_DATA_FILES.items():
+        tx_data = read_tx_data(f"{dir_path}/{file_name}")
+        if tx_data is None:
+            continue
+
+        blocks[data_type] = {int(block_num): block_data for block_num, block_data in tx_data.items()}
+
+    if not blocks:
+        return None
+
+    return blocks, stats.read_contract_profiles(dir_path)
+
+
+def get_top_n(data: dict, n: int) -> dict:
+    """Return the first n entries of a stats dict. Dicts of numbers are sorted by value in descending order first,
+    while dicts of records keep their order (the stats functions already return them sorted)."""
+
+    items = list(data.items())
+    if items and isinstance(items[0][1], (int, float)):
+        items = sorted(items, reverse=True, key=lambda item: item[1])
+
+    return dict(items[:n])
+
+
+def parse_range(request: web.Request, store: StatsStore) -> Tuple[int, int]:
+    try:
+        start_block = int(request.query['start']) if 'start' in request.query else None
+        end_block = int(request.query['end']) if 'end' in request.query else None
+    except ValueError:
+        raise web.HTTPBadRequest(reason="start and end must be block numbers")
+
+    return store.get_range(start_block, end_block)
+
+
+def parse_stats_type(request: web.Request) -> StatsType:
+    try:
+        return StatsType(request.match_info['stats_type'].upper())
+    except ValueError:
+        raise web.HTTPNotFound(reason=f"Unknown stats type: {request.match_info['stats_type']}")
+
+
+async def stream_items(request: web.Request, items) -> web.StreamResponse:
+    """Stream the items as newline delimited JSON, one [key, value] pair per line."""
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    for key, value in items:
+        await response.write((json.dumps([key, value]) + "\n").encode())
+    await response.write_eof()
+
+    return response
+
+
+async def handle_windows(request: web.Request) -> web.Response:
+    store: StatsStore = request.app['store']
+    return web.json_response(store.windows)
+
+
+async def handle_stats(request: web.Request) -> web.StreamResponse:
+    store: StatsStore = request.app['store']
+    stats_type = parse_stats_type(request)
+    start_block, end_block = parse_range(request, store)
+    data = await store.get_stats(stats_type, start_block, end_block)
+
+    if request.query.get('stream'):
+        return await stream_items(request, data.items())
+
+    return web.json_response(data)
+
+
+async def handle_top(request: web.Request) -> web.Response:
+    store: StatsStore = request.app['store']
+    stats_type = parse_stats_type(request)
+    start_block, end_block = parse_range(request, store)
+    try:
+        n = int(request.query.get('n', 10))
+    except ValueError:
+        raise web.HTTPBadRequest(reason="n must be a number")
+    data = await store.get_stats(stats_type, start_block, end_block)
+
+    if stats_type == StatsType.CONTRACT_PROFILES:
+        if 'opcode' not in request.query:
+            raise web.HTTPBadRequest(reason="opcode is required for contract top-N queries")
+        return web.json_response(stats.get_top_contracts(data, request.query['opcode'], n))
+    elif stats_type == StatsType.OPCODE_NGRAMS:
+        return web.json_response({ngram_size: get_top_n(ngrams, n) for ngram_size, ngrams in data.items()})
+
+    return web.json_response(get_top_n(data, n))
+
+
+async def handle_opcode(request: web.Request) -> web.Response:
+    store: StatsStore = request.app['store']
+    start_block, end_block = parse_range(request, store)
+    return web.json_response(await store.get_opcode(request.match_info['opcode'].upper(), start_block, end_block))
+
+
+async def handle_blocks(request: web.Request) -> web.StreamResponse:
+    """Stream the per tx data of every block in the range."""
+
+    store: StatsStore = request.app['store']
+    start_block, end_block = parse_range(request, store)
+    try:
+        data_type = TraceDataType(request.query.get('type', TraceDataType.OPCODES.value).upper())
+    except ValueError:
+        raise web.HTTPBadRequest(reason=f"Unknown trace data type: {request.query.get('type')}")
+
+    blocks = store.select(data_type, start_block, end_block)
+
+    return await stream_items(request, sorted(blocks.items()))
+
+
+async def handle_ingest(request: web.Request) -> web.Response:
+    """(Re)load a window, e.g. after new blocks were fetched for it. Body: {"start_block": ..., "end_block": ...}"""
+
+    store: StatsStore = request.app['store']
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(reason="The body must be JSON")
+
+    try:
+        start_block, end_block = int(body['start_block']), int(body['end_block'])
+    except (KeyError, TypeError, ValueError):
+        raise web.HTTPBadRequest(reason="start_block and end_block are required")
+
+    # Reading a window is blocking file IO, so it runs in an executor to keep serving the other requests.
+    window_data = await asyncio.get_running_loop().run_in_executor(None, read_window, start_block, end_block)
+    if window_data is None:
+        raise web.HTTPNotFound(reason=f"No trace data found for blocks: {start_block} - {end_block}")
+
+    store.add_window(start_block, end_block, *window_data)
+
+    return web.json_response(store.windows)
+
+
+def make_app(blocks: List[Tuple[int, int]], cache_size: int = CACHE_SIZE) -> web.Application:
+    store = StatsStore(cache_size)
+    for start_block, end_block in blocks:
+        if not store.load_window(start_block, end_block):
+            logging.warning(f"No trace data found for blocks: {start_block} - {end_block}, window skipped.")
+
+    app = web.Application()
+    app['store'] = store
+    app.add_routes([
+        web.get('/windows', handle_windows),
+        web.get('/stats/{stats_type}', handle_stats),
+        web.get('/top/{stats_type}', handle_top),
+        web.get('/opcodes/{opcode}', handle_opcode),
+        web.get('/blocks', handle_blocks),
+        web.post('/ingest', handle_ingest),
+    ])
+
+    return app
+
+
+if __name__ == '__main__':
+    with open(f'./{LATEST_BLOCK}.json', 'r') as f:
+        blocks = json.loads(f.read())
+
+    web.run_app(make_app(blocks), host=HOST, port=PORT)
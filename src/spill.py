@@ -0,0 +1,204 @@
+import os
+import json
+import shutil
+import tempfile
+import heapq
+import itertools
+import logging
+from typing import Dict, Union, Tuple, List, Iterator
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+# Memory budget for the per tx data accumulated while tracing a window, 0 means no budget.
+# The raw structLogs of the block being traced (held until all its traces are gathered) are not counted.
+MEMORY_BUDGET = int(os.environ.get('MEMORY_BUDGET_MB') or 0) * 1024 * 1024
+# Rough in-memory size of a counted entry (a dict slot holding a str key and an int value).
+ENTRY_SIZE = 128
+
+
+class SpilledTxData:
+    """Per tx data ({block_num: {tx_hash: data}}) stored on disk as a JSON lines file sorted by block,
+    with one [block_num, block_data] pair per line. It exposes the dict methods used by the stats functions,
+    reading the file on every pass, so stats can be computed without loading the window in memory.
+    temp_dir is the temp dir the file was merged in, if any; it is removed once write_tx_data moves the file out."""
+
+    def __init__(self, path: str, temp_dir: Union[str, None] = None):
+        self.path = path
+        self.temp_dir = temp_dir
+        self._offsets: Union[Dict[str, int], None] = None
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        with open(self.path, "r") as f:
+            for line in f:
+                block_num, block_data = json.loads(line)
+                yield block_num, block_data
+
+    def values(self) -> Iterator[dict]:
+        for block_num, block_data in self.items():
+            yield block_data
+
+    def keys(self) -> List[str]:
+        return list(self._get_offsets().keys())
+
+    def get(self, block_num: Union[int, str], default=None) -> Union[dict, None]:
+        offset = self._get_offsets().get(str(block_num))
+        if offset is None:
+            return default
+
+        with open(self.path, "r") as f:
+            f.seek(offset)
+            return json.loads(f.readline())[1]
+
+    def __getitem__(self, block_num: Union[int, str]) -> dict:
+        block_data = self.get(block_num)
+        if block_data is None:
+            raise KeyError(block_num)
+
+        return block_data
+
+    def __contains__(self, block_num: Union[int, str]) -> bool:
+        return str(block_num) in self._get_offsets()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self._get_offsets())
+
+    def _get_offsets(self) -> Dict[str, int]:
+        """Index the file offset of every block line, reading only the block number of each line."""
+
+        if self._offsets is None:
+            self._offsets = dict()
+            with open(self.path, "r") as f:
+                offset = f.tell()
+                line = f.readline()
+                while line:
+                    self._offsets[str(json.loads(line[1:line.index(',')]))] = offset
+                    offset = f.tell()
+                    line = f.readline()
+
+        return self._offsets
+
+
+class SpillBuffer:
+    """Accumulates per block tx data in memory. When spill is called the buffered blocks are written,
+    sorted by block, to a new run file in dir_path (a new temp dir if not given); finish merges the runs
+    into dir_path/file_name."""
+
+    def __init__(self, file_name: str, dir_path: Union[str, None] = None):
+        self.file_name = file_name
+        self.dir_path = dir_path
+        self.temp_dir: Union[str, None] = None
+        self.data: dict = dict()
+        self.size = 0
+        self.runs: List[str] = []
+
+    def add_block(self, block_num: Union[int, str], block_data: dict):
+        self.data[block_num] = block_data
+        self.size += count_entries(block_data) * ENTRY_SIZE
+
+    def spill(self):
+        if not self.data:
+            return
+
+        if self.dir_path is None:
+            self.dir_path = self.temp_dir = tempfile.mkdtemp()
+
+        run_path = f"{self.dir_path}/{self.file_name}.run{len(self.runs)}"
+        write_run(run_path, self.data.items())
+        self.runs.append(run_path)
+        logging.debug(f"Spilled {len(self.data)} blocks to {run_path}.")
+
+        self.data = dict()
+        self.size = 0
+
+    def finish(self) -> Union[dict, SpilledTxData]:
+        """Return the buffered data as a dict if nothing was spilled, otherwise merge the runs into path."""
+
+        if not self.runs:
+            return self.data
+
+        self.spill()
+        path = f"{self.dir_path}/{self.file_name}"
+        merge_runs(self.runs, path)
+        for run_path in self.runs:
+            os.remove(run_path)
+        self.runs = []
+
+        return SpilledTxData(path, self.temp_dir)
+
+
+def spill_over_budget(buffers: List[SpillBuffer], memory_budget: int = MEMORY_BUDGET):
+    """Spill all buffers once their combined size exceeds the memory budget (0 means no budget)."""
+
+    if memory_budget and sum(buffer.size for buffer in buffers) > memory_budget:
+        for buffer in buffers:
+            buffer.spill()
+
+
+def count_entries(data: dict) -> int:
+    """Return the number of leaf entries in a nested dict (list items count as entries)."""
+
+    return sum(count_entries(value) if isinstance(value, dict) else len(value) if isinstance(value, list) else 1 for value in data.values()) + 1
+
+
+def write_run(run_path: str, blocks):
+    with open(run_path, "w") as f:
+        for block_num, block_data in sorted(blocks, key=lambda item: int(item[0])):
+            f.write(json.dumps([block_num, block_data]) + "\n")
+
+
+def read_run(run_path: str) -> Iterator[Tuple[str, dict]]:
+    return SpilledTxData(run_path).items()
+
+
+def merge_runs(run_paths: List[str], path: str):
+    """K-way merge the sorted runs into path. Data of a block found in several runs is combined."""
+
+    merged_blocks = heapq.merge(*[read_run(run_path) for run_path in run_paths], key=lambda item: int(item[0]))
+
+    with open(path, "w") as f:
+        for block_num, blocks in itertools.groupby(merged_blocks, key=lambda item: item[0]):
+            block_data = dict()
+            for _, run_block_data in blocks:
+                block_data.update(run_block_data)
+            f.write(json.dumps([block_num, block_data]) + "\n")
+
+
+def write_tx_data(base_path: str, data: Union[dict, SpilledTxData]):
+    """Persist per tx data to base_path.json, or keep it as base_path.jsonl if it was spilled.
+    The file in the other format is removed so a stale copy is never read back, and so is the temp dir the spilled data was merged in."""
+
+    json_path, jsonl_path = f"{base_path}.json", f"{base_path}.jsonl"
+
+    if isinstance(data, SpilledTxData):
+        if os.path.abspath(data.path) != os.path.abspath(jsonl_path):
+            shutil.move(data.path, jsonl_path)
+            data.path = jsonl_path
+            if data.temp_dir is not None:
+                shutil.rmtree(data.temp_dir, ignore_errors=True)
+                data.temp_dir = None
+        stale_path = json_path
+    else:
+        with open(json_path, "w") as f:
+            f.write(json.dumps(data))
+        stale_path = jsonl_path
+
+    if os.path.isfile(stale_path):
+        os.remove(stale_path)
+
+
+def read_tx_data(base_path: str) -> Union[dict, SpilledTxData, None]:
+    """Read per tx data written by write_tx_data. Spilled data is returned as a SpilledTxData that streams from disk."""
+
+    if os.path.isfile(f"{base_path}.jsonl"):
+        return SpilledTxData(f"{base_path}.jsonl")
+
+    if os.path.isfile(f"{base_path}.json"):
+        with open(f"{base_path}.json", "r") as f:
+            return json.loads(f.read())
+
+    return None
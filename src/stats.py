@@ -1,11 +1,19 @@
+import os
 import json
-from typing import Dict, Union, Tuple
+import heapq
+from typing import Dict, Union, Tuple, List
 import logging
 from .utils import StatsType
 logging.basicConfig(level=logging.INFO)
 
+NGRAM_TOP_K = 50
+# Number of counters per n-gram size kept while merging tx n-gram tables (see merge_ngram_counts).
+MAX_TRACKED_NGRAMS = 100_000
+# How many of the top contracts are indexed for each opcode.
+CONTRACT_INDEX_SIZE = 100
 
-def make_stats(trace_logs: Dict[Tuple[int, int], dict]) -> Dict[Tuple[int, int], Dict[StatsType, dict]]:
+
+def make_stats(trace_logs: Dict[Tuple[int, int], dict], ngram_logs: Union[Dict[Tuple[int, int], dict], None] = None, gas_logs: Union[Dict[Tuple[int, int], dict], None] = None, contract_logs: Union[Dict[Tuple[int, int], dict], None] = None) -> Dict[Tuple[int, int], Dict[StatsType, dict]]:
 
     stats = dict()
 
@@ -18,9 +26,21 @@ def make_stats(trace_logs: Dict[Tuple[int, int], dict]) -> Dict[Tuple[int, int],
         stats[(start_block, end_block)][StatsType.TOTAL_AMOUNT_OPCODES] = make_total_amount_opcodes_stats(tx_opcodes, dir_path)
         stats[(start_block, end_block)][StatsType.OPCODE_COUNTS] = make_opcode_counts_stats(tx_opcodes, dir_path)
         stats[(start_block, end_block)][StatsType.OPCODE_STATS] = make_opcode_stats(tx_opcodes, dir_path)
-        opcode_frequencies = {opcode: opcode_data['frequency'] for opcode, opcode_data in stats[(start_block, end_block)][StatsType.OPCODE_STATS].items()}
-        opcode_frequencies = {k: v for k, v in sorted(opcode_frequencies.items(), key=lambda item: item[1])}
-        stats[(start_block, end_block)][StatsType.OPCODE_BLOCK_FREQUENCY] = opcode_frequencies
+        stats[(start_block, end_block)][StatsType.OPCODE_BLOCK_FREQUENCY] = get_opcode_block_frequencies(stats[(start_block, end_block)][StatsType.OPCODE_STATS])
+
+        if ngram_logs and (start_block, end_block) in ngram_logs:
+            stats[(start_block, end_block)][StatsType.OPCODE_NGRAMS] = make_opcode_ngram_stats(ngram_logs[(start_block, end_block)], dir_path)
+
+        if gas_logs and (start_block, end_block) in gas_logs:
+            tx_gas = gas_logs[(start_block, end_block)]
+            stats[(start_block, end_block)][StatsType.OPCODE_GAS] = make_opcode_gas_stats(tx_opcodes, tx_gas, dir_path)
+            stats[(start_block, end_block)][StatsType.OPCODE_GAS_STATS] = make_opcode_gas_share_stats(stats[(start_block, end_block)][StatsType.OPCODE_GAS], stats[(start_block, end_block)][StatsType.OPCODE_COUNTS], dir_path)
+
+        if contract_logs and (start_block, end_block) in contract_logs:
+            contract_stats = read_contract_profiles(dir_path)
+            if contract_stats is None:
+                contract_stats = make_contract_profile_stats(contract_logs[(start_block, end_block)], dir_path)
+            stats[(start_block, end_block)][StatsType.CONTRACT_PROFILES] = contract_stats
 
     return stats
 
@@ -64,6 +84,62 @@ def make_opcode_stats(tx_opcodes: dict, dir_path: str = '.') -> dict:
 
     return opcode_stats
 
+
+def make_opcode_ngram_stats(tx_ngrams: dict, dir_path: str = '.', top_k: int = NGRAM_TOP_K) -> Dict[int, Dict[str, int]]:
+    logging.debug("Calculating opcode n-gram stats...")
+    ngram_counts = get_opcode_ngram_counts(tx_ngrams)
+    top_ngrams = get_top_ngrams(ngram_counts, top_k)
+    with open(f"{dir_path}/opcode_ngrams.json", "w") as f:
+        f.write(json.dumps(top_ngrams))
+    logging.debug(f"Opcode n-gram stats calculated and saved to file in  {dir_path} .")
+
+    return top_ngrams
+
+
+def make_opcode_gas_stats(tx_opcodes: dict, tx_gas: dict, dir_path: str = '.') -> dict:
+    logging.debug("Calculating opcode gas stats...")
+    opcode_gas = get_opcode_gas(tx_opcodes, tx_gas)
+    with open(f"{dir_path}/opcode_gas.json", "w") as f:
+        f.write(json.dumps(opcode_gas))
+    logging.debug(f"Opcode gas stats calculated and saved to file in  {dir_path} .")
+
+    return opcode_gas
+
+
+def make_opcode_gas_share_stats(opcode_gas: Dict[str, int], opcode_counts: Dict[str, int], dir_path: str = '.') -> dict:
+    logging.debug("Calculating opcode gas share stats...")
+    opcode_gas_stats = get_opcode_gas_stats(opcode_gas, opcode_counts)
+    with open(f"{dir_path}/opcode_gas_stats.json", "w") as f:
+        f.write(json.dumps(opcode_gas_stats))
+    logging.debug(f"Opcode gas share stats calculated and saved to file in  {dir_path} .")
+
+    return opcode_gas_stats
+
+
+def make_contract_profile_stats(tx_contract_opcodes: dict, dir_path: str = '.', index_size: int = CONTRACT_INDEX_SIZE) -> dict:
+    logging.debug("Calculating contract profile stats...")
+    contract_profiles = get_contract_profiles(tx_contract_opcodes)
+    contract_stats = {
+        'contracts': contract_profiles,
+        'index': get_contract_opcode_index(contract_profiles, index_size),
+    }
+    with open(f"{dir_path}/contract_profiles.json", "w") as f:
+        f.write(json.dumps(compact_contract_profiles(contract_stats)))
+    logging.debug(f"Contract profile stats calculated and saved to file in  {dir_path} .")
+
+    return contract_stats
+
+
+def read_contract_profiles(dir_path: str = '.') -> Union[dict, None]:
+    """Read the contract stats persisted by make_contract_profile_stats, None if the window has none yet."""
+
+    if not os.path.isfile(f"{dir_path}/contract_profiles.json"):
+        return None
+
+    with open(f"{dir_path}/contract_profiles.json", "r") as f:
+        return expand_contract_profiles(json.loads(f.read()))
+
+
 def get_num_opcodes_per_block(tx_opcodes: Dict[int, Dict[str, Dict[str, int]]], start_block: Union[int, None] = None, end_block: Union[int, None] = None) -> Dict[int, int]:
     """Return the number of unique opcodes (opcode count, not the quantities of each opcode) that appeared in a block.
     The counts are obtained for all transactions in the tx_opcodes dict.
@@ -187,12 +263,208 @@ def get_opcode_stats(tx_opcodes: Dict[int, Dict[str, Dict[str, int]]], start_blo
     return opcode_stats
 
 
-def filter_tx_opcodes(tx_opcodes: Dict[int, Dict[str, Dict[str, int]]], start_block: int, end_block: int) -> Dict[int, Dict[str, Dict[str, int]]]:
+def get_opcode_block_frequencies(opcode_stats: Dict[str, dict]) -> Dict[str, int]:
+    """Return the block frequency of each opcode from the get_opcode_stats result, sorted in ascending order."""
+
+    opcode_frequencies = {opcode: opcode_data['frequency'] for opcode, opcode_data in opcode_stats.items()}
+
+    return {k: v for k, v in sorted(opcode_frequencies.items(), key=lambda item: item[1])}
+
+
+def get_opcode_gas(tx_opcodes: Dict[int, Dict[str, Dict[str, int]]], tx_gas: Dict[int, Dict[str, List[int]]], start_block: Union[int, None] = None, end_block: Union[int, None] = None) -> Dict[str, int]:
+    """Return the total gas spent by each opcode, sorted by gas in descending order.
+    tx_gas holds for each tx the gas of its opcodes, in the order the opcodes appear in tx_opcodes.
+    If start_block and end_block are specified, then only the transactions
+     in the range [start_block, end_block) are considered."""
+
+    opcode_gas: Dict[str, int] = dict()
+
     filtered_opcodes = tx_opcodes
 
+    if start_block and end_block:
+        filtered_opcodes = filter_tx_opcodes(tx_opcodes, start_block, end_block)
+
+    for block_num, block_data in filtered_opcodes.items():
+        block_gas = tx_gas.get(block_num, dict())
+        for tx_hash, tx_data in block_data.items():
+            for opcode, gas in zip(tx_data.keys(), block_gas.get(tx_hash, [])):
+                opcode_gas[opcode] = opcode_gas.get(opcode, 0) + gas
+
+    return {k: v for k, v in sorted(opcode_gas.items(), reverse=True, key=lambda item: item[1])}
+
+
+def get_opcode_gas_stats(opcode_gas: Dict[str, int], opcode_counts: Dict[str, int]) -> Dict[str, dict]:
+    """Returns gas stats for each opcode from the opcode gas (see get_opcode_gas) and counts of the same blocks.
+    The stats contain the following fields:
+        - gas - total gas spent by the opcode in the blocks
+        - gas percent - (gas)/(total gas spent by all opcodes in the blocks)
+        - count - how many times the opcode appeared in the blocks
+        - average gas - (gas)/(count)
+    """
+
+    total_gas = sum(opcode_gas.values())
+
+    opcode_gas_stats: Dict[str, dict] = dict()
+    for opcode, gas in opcode_gas.items():
+        count = opcode_counts.get(opcode, 0)
+        opcode_gas_stats[opcode] = {
+            'gas': gas,
+            'gas_percent': (gas / total_gas) * 100 if total_gas else 0,
+            'count': count,
+            'avg_gas': gas / count if count else 0,
+        }
+
+    return opcode_gas_stats
+
+
+def get_contract_profiles(tx_contract_opcodes: Dict[int, Dict[str, Dict[str, Dict[str, int]]]], start_block: Union[int, None] = None, end_block: Union[int, None] = None) -> Dict[str, dict]:
+    """Returns the opcode profile of each contract. The profiles contain the following fields:
+        - tx_count - in how many transactions the contract code was executed
+        - opcodes - how many times each opcode was executed in the contract code
+    """
+
+    contract_profiles: Dict[str, dict] = dict()
+
+    filtered_opcodes = tx_contract_opcodes
+
+    if start_block and end_block:
+        filtered_opcodes = filter_tx_opcodes(tx_contract_opcodes, start_block, end_block)
+
+    for block_num, block_data in filtered_opcodes.items():
+        for tx_hash, tx_data in block_data.items():
+            for contract, opcodes in tx_data.items():
+                if contract not in contract_profiles:
+                    contract_profiles[contract] = {
+                        'tx_count': 0,
+                        'opcodes': dict(),
+                    }
+
+                contract_profiles[contract]['tx_count'] += 1
+                contract_opcodes = contract_profiles[contract]['opcodes']
+                for opcode, count in opcodes.items():
+                    contract_opcodes[opcode] = contract_opcodes.get(opcode, 0) + count
+
+    return contract_profiles
+
+
+def merge_contract_profiles(contract_profiles_list: List[Dict[str, dict]]) -> Dict[str, dict]:
+    """Merge the contract profiles of several block ranges into the profiles of their union."""
+
+    merged_profiles: Dict[str, dict] = dict()
+    for contract_profiles in contract_profiles_list:
+        for contract, profile in contract_profiles.items():
+            if contract not in merged_profiles:
+                merged_profiles[contract] = {
+                    'tx_count': 0,
+                    'opcodes': dict(),
+                }
+
+            merged_profiles[contract]['tx_count'] += profile['tx_count']
+            merged_opcodes = merged_profiles[contract]['opcodes']
+            for opcode, count in profile['opcodes'].items():
+                merged_opcodes[opcode] = merged_opcodes.get(opcode, 0) + count
+
+    return merged_profiles
+
+
+def get_contract_opcode_index(contract_profiles: Dict[str, dict], index_size: int = CONTRACT_INDEX_SIZE) -> Dict[str, List[str]]:
+    """Return, for each opcode, the index_size contracts that executed it the most, sorted by count in descending order."""
+
+    opcode_contracts: Dict[str, List[Tuple[int, str]]] = dict()
+    for contract, profile in contract_profiles.items():
+        for opcode, count in profile['opcodes'].items():
+            opcode_contracts.setdefault(opcode, []).append((count, contract))
+
+    return {opcode: [contract for count, contract in heapq.nlargest(index_size, contracts)] for opcode, contracts in opcode_contracts.items()}
+
+
+def get_top_contracts(contract_stats: dict, opcode: str, n: int = 10) -> List[Tuple[str, int]]:
+    """Return the (contract, count) pairs of the n contracts that executed the opcode the most.
+    n is bounded by the index size used when the contract stats were made."""
+
+    contracts = contract_stats['contracts']
+
+    return [(contract, contracts[contract]['opcodes'][opcode]) for contract in contract_stats['index'].get(opcode, [])[:n]]
+
+
+def compact_contract_profiles(contract_stats: dict) -> dict:
+    """Return the contract stats in the form they are persisted in: opcodes are replaced by their position
+    in a shared opcode list, the profiles are stored as [tx_count, [[opcode_index, count], ...]] and
+    the opcode index as a list of contracts aligned with the opcode list."""
+
+    opcodes = sorted(contract_stats['index'].keys())
+    opcode_indices = {opcode: i for i, opcode in enumerate(opcodes)}
+
+    return {
+        'opcodes': opcodes,
+        'contracts': {contract: [profile['tx_count'], [[opcode_indices[opcode], count] for opcode, count in profile['opcodes'].items()]] for contract, profile in contract_stats['contracts'].items()},
+        'index': [contract_stats['index'][opcode] for opcode in opcodes],
+    }
+
+
+def expand_contract_profiles(compact_stats: dict) -> dict:
+    """Inverse of compact_contract_profiles."""
+
+    opcodes = compact_stats['opcodes']
+
+    return {
+        'contracts': {contract: {'tx_count': tx_count, 'opcodes': {opcodes[i]: count for i, count in contract_opcodes}} for contract, (tx_count, contract_opcodes) in compact_stats['contracts'].items()},
+        'index': {opcode: contracts for opcode, contracts in zip(opcodes, compact_stats['index'])},
+    }
+
+
+def get_opcode_ngram_counts(tx_ngrams: Dict[int, Dict[str, Dict[int, Dict[str, int]]]], start_block: Union[int, None] = None, end_block: Union[int, None] = None, max_ngrams: int = MAX_TRACKED_NGRAMS) -> Dict[int, Dict[str, int]]:
+    """Return how many times each opcode n-gram from the tx_ngrams dict is found, grouped by n-gram size.
+    Every size is summarised in a bounded table, so the counts are estimates (see merge_ngram_counts).
+    If start_block and end_block are specified, then only the transactions
+     in the range [start_block, end_block) are considered."""
+
+    ngram_counts: Dict[int, Dict[str, int]] = dict()
+
+    filtered_ngrams = tx_ngrams
+
+    if start_block and end_block:
+        filtered_ngrams = filter_tx_opcodes(tx_ngrams, start_block, end_block)
+
+    for block_num, block_data in filtered_ngrams.items():
+        for tx_hash, tx_data in block_data.items():
+            merge_ngram_counts(ngram_counts, tx_data, max_ngrams)
+
+    return ngram_counts
+
+
+def merge_ngram_counts(ngram_counts: Dict[int, Dict[str, int]], tx_ngrams: Dict[int, Dict[str, int]], max_ngrams: int = MAX_TRACKED_NGRAMS) -> Dict[int, Dict[str, int]]:
+    """Add the exact per n-gram size counts of a tx ({n: {ngram: count}}) to the tables of ngram_counts (in place) and return it.
+    Each size is a weighted Misra-Gries summary: once its table holds more than 2 * max_ngrams entries,
+    the (max_ngrams + 1)-th largest count is subtracted from every entry and the entries left at zero are dropped.
+    A count then underestimates the true count by at most N / (max_ngrams + 1), N being the total count
+    of the n-grams of that size, and every n-gram more frequent than that is guaranteed to be in the table."""
+
+    for n, size_ngrams in tx_ngrams.items():
+        n = int(n)
+        counts = ngram_counts.setdefault(n, dict())
+        for ngram, count in size_ngrams.items():
+            counts[ngram] = counts.get(ngram, 0) + count
+
+        if len(counts) > 2 * max_ngrams:
+            threshold = heapq.nlargest(max_ngrams + 1, counts.values())[-1]
+            ngram_counts[n] = {ngram: count - threshold for ngram, count in counts.items() if count > threshold}
+
+    return ngram_counts
+
+
+def get_top_ngrams(ngram_counts: Dict[int, Dict[str, int]], top_k: int = NGRAM_TOP_K) -> Dict[int, Dict[str, int]]:
+    """Return the top_k most frequent n-grams for each n-gram size, sorted by count in descending order."""
+
+    return {n: dict(heapq.nlargest(top_k, ngrams.items(), key=lambda item: item[1])) for n, ngrams in sorted(ngram_counts.items())}
+
+
+def filter_tx_opcodes(tx_opcodes: Dict[int, Dict[str, Dict[str, int]]], start_block: int, end_block: int) -> Dict[int, Dict[str, Dict[str, int]]]:
+    filtered_opcodes = dict()
+
     for block_num, block_data in tx_opcodes.items():
         block_num_int = int(block_num)
-        if block_num_int >= start_block or block_num_int < end_block:
+        if start_block <= block_num_int < end_block:
             filtered_opcodes[block_num] = block_data
 
     return filtered_opcodes
@@ -1,28 +1,34 @@
-import json
-import os.path
-
 import aiohttp
 import asyncio
 import api.eth_requests as eth_requests
 from typing import Dict, Union, Tuple, List
+from .utils import TraceDataType, CONTRACT_CREATION, TRACE_DATA_FILES
+from .spill import SpillBuffer, SpilledTxData, MEMORY_BUDGET, spill_over_budget, read_tx_data, write_tx_data
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
+# The EVM has at most 256 opcodes, so every opcode name fits in a single byte code.
+OPCODE_BITS = 8
+
+_opcode_codes: Dict[str, int] = dict()
+_opcode_names: List[str] = []
+
+# Opcodes that take the callee address as their second stack argument.
+CALL_OPCODES = {'CALL', 'CALLCODE', 'DELEGATECALL', 'STATICCALL'}
 
-async def read_trace_logs(blocks: List[Tuple[int, int]], session: aiohttp.ClientSession) -> Dict[Tuple[int, int], dict]:
+
+async def read_trace_logs(blocks: List[Tuple[int, int]], session: aiohttp.ClientSession) -> Dict[Tuple[int, int], Union[dict, SpilledTxData]]:
     trace_logs = dict()
 
     for start_block, end_block in blocks:
-        tx_opcode_stats_path = f"./{start_block}_{end_block}/tx_opcode_stats.json"
-        if os.path.isfile((tx_opcode_stats_path)):
-            with open(tx_opcode_stats_path, "r") as f:
-                tx_opcodes = json.loads(f.read())
-        else:
+        dir_path = f"./{start_block}_{end_block}"
+        tx_opcode_stats_path = f"{dir_path}/{TRACE_DATA_FILES[TraceDataType.OPCODES]}"
+        tx_opcodes = read_tx_data(tx_opcode_stats_path)
+        if tx_opcodes is None:
             logging.debug(f"Getting trace logs for blocks: {start_block} - {end_block}.")
-            tx_opcodes = await get_block_trace_logs(start_block, end_block, session)
-            with open(tx_opcode_stats_path, "w") as f:
-                f.write(json.dumps(tx_opcodes))
+            tx_opcodes = await get_block_trace_logs(start_block, end_block, session, dir_path)
+            write_tx_data(tx_opcode_stats_path, tx_opcodes)
 
         trace_logs[(start_block, end_block)] = tx_opcodes
 
@@ -31,18 +37,19 @@ async def read_trace_logs(blocks: List[Tuple[int, int]], session: aiohttp.Client
     return trace_logs
 
 
-async def get_block_trace_logs(start_block: int, end_block: int, session: aiohttp.ClientSession) -> dict:
-    tx_opcodes = await get_opcodes_for_txs(start_block, end_block, session)
+async def get_block_trace_logs(start_block: int, end_block: int, session: aiohttp.ClientSession, spill_dir: Union[str, None] = None) -> Union[dict, SpilledTxData]:
+    tx_opcodes = await get_opcodes_for_txs(start_block, end_block, session, spill_dir=spill_dir)
     return tx_opcodes
 
 
-async def get_opcodes_for_txs(start_block: int, end_block: int, session: aiohttp.ClientSession) -> Dict[int, Dict[str, Dict[str, int]]]:
-    """Get opcode counts for transactions that appear in the blocks: [start_block, end_block). """
+async def get_opcodes_for_txs(start_block: int, end_block: int, session: aiohttp.ClientSession, memory_budget: int = MEMORY_BUDGET, spill_dir: Union[str, None] = None) -> Union[Dict[int, Dict[str, Dict[str, int]]], SpilledTxData]:
+    """Get opcode counts for transactions that appear in the blocks: [start_block, end_block).
+    If the data outgrows memory_budget it is spilled to spill_dir (a temp dir by default) and returned as SpilledTxData."""
 
-    data: Dict[int, Dict[str, Dict[str, int]]] = dict()
+    buffer = SpillBuffer(f"{TRACE_DATA_FILES[TraceDataType.OPCODES]}.jsonl", spill_dir)
 
     for block_num in range(start_block, end_block):
-        data[block_num] = dict()
+        block_opcodes = dict()
 
         block_data = eth_requests.get_block_by_number(block_num, True)
         filtered_tx_hashes = get_filtered_tx_hashes(block_data.get('transactions'))
@@ -50,29 +57,57 @@ async def get_opcodes_for_txs(start_block: int, end_block: int, session: aiohttp
         debug_traces = await asyncio.gather(*[eth_requests.debug_tx_async(session, tx_hash) for tx_hash in filtered_tx_hashes])
 
         for trace, tx_hash in debug_traces:
-            if trace:
-                data[block_num][tx_hash] = get_opcode_counts_from_tx_debug_trace(trace)
+            if trace and not trace.get('failed'):
+                block_opcodes[tx_hash] = get_opcode_counts_from_tx_debug_trace(trace)
 
-    return data
+        buffer.add_block(block_num, block_opcodes)
+        spill_over_budget([buffer], memory_budget)
 
+    return buffer.finish()
 
-async def get_opcodes_for_tx_hashes(session: aiohttp.ClientSession, block_data: Dict[int, List[str]]) -> Dict[int, Dict[str, Dict[str, int]]]:
-    """Get opcode counts for transactions that appear in the blocks: [start_block, end_block). """
 
-    data: Dict[int, Dict[str, Dict[str, int]]] = dict()
+async def get_trace_stats_for_tx_hashes(session: aiohttp.ClientSession, block_data: Dict[int, List[str]], ngram_size: int = 0, tx_contracts: Union[Dict[str, str], None] = None, call_frames: bool = False, memory_budget: int = MEMORY_BUDGET, spill_dir: Union[str, None] = None) -> Dict[TraceDataType, Union[Dict[int, Dict[str, dict]], SpilledTxData]]:
+    """Get the per tx trace data (opcode counts, opcode gas and, if ngram_size > 1, opcode n-gram counts)
+    for the transactions in block_data. Every trace is parsed in a single pass; failed txs are skipped.
+    If tx_contracts (tx hash -> `to` address) is given, the per contract opcode counts of each tx are collected too
+    (txs missing from tx_contracts are not attributed to any contract);
+    with call_frames the traces are fetched with the stack so opcodes are attributed to the callee of every call frame.
+    Once the data of all types outgrows memory_budget it is spilled per block to sorted runs in spill_dir (a temp dir by default),
+    and the types that were spilled are returned as SpilledTxData. The budget doesn't count the raw structLogs of the
+    block being traced, which are all held in memory until asyncio.gather returns."""
+
+    data_types = [TraceDataType.OPCODES, TraceDataType.OPCODE_GAS]
+    if ngram_size > 1:
+        data_types.append(TraceDataType.OPCODE_NGRAMS)
+    if tx_contracts is not None:
+        data_types.append(TraceDataType.CONTRACT_OPCODES)
+
+    buffers = {data_type: SpillBuffer(f"{TRACE_DATA_FILES[data_type]}.jsonl", spill_dir) for data_type in data_types}
 
     for block_num, tx_hashes in block_data.items():
-        data[block_num] = dict()
+        data: Dict[TraceDataType, Dict[str, dict]] = {data_type: dict() for data_type in data_types}
 
-        debug_traces = await asyncio.gather(*[eth_requests.debug_tx_async(session, tx_hash) for tx_hash in tx_hashes])
+        debug_traces = await asyncio.gather(*[eth_requests.debug_tx_async(session, tx_hash, not call_frames) for tx_hash in tx_hashes])
 
         for trace, tx_hash in debug_traces:
-            if trace:
-                data[block_num][tx_hash] = get_opcode_counts_from_tx_debug_trace(trace)
+            if trace and not trace.get('failed'):
+                contract = tx_contracts.get(tx_hash) if tx_contracts is not None else None
+                for data_type, tx_data in get_tx_trace_stats(trace, ngram_size, contract, call_frames).items():
+                    data[data_type][tx_hash] = tx_data
+
+        for data_type, block_tx_data in data.items():
+            buffers[data_type].add_block(block_num, block_tx_data)
+        spill_over_budget(list(buffers.values()), memory_budget)
 
-    return data
+    return {data_type: buffer.finish() for data_type, buffer in buffers.items()}
 
 
+async def get_opcodes_for_tx_hashes(session: aiohttp.ClientSession, block_data: Dict[int, List[str]], memory_budget: int = MEMORY_BUDGET, spill_dir: Union[str, None] = None) -> Union[Dict[int, Dict[str, Dict[str, int]]], SpilledTxData]:
+    """Get opcode counts for transactions that appear in the blocks: [start_block, end_block). """
+
+    data = await get_trace_stats_for_tx_hashes(session, block_data, memory_budget=memory_budget, spill_dir=spill_dir)
+    return data[TraceDataType.OPCODES]
+
 
 def get_filtered_tx_hashes(full_txs: List[Dict]) -> List[str]:
     filtered_tx_hashes = []
@@ -89,14 +124,155 @@ def get_opcode_counts_from_tx_debug_trace(debug_trace: dict):
     """Parses the debug trace obtained from debug_traceTransaction calls and
     returns a dict with the opcodes appearing in the tx and their counts."""
 
+    return get_tx_trace_stats(debug_trace)[TraceDataType.OPCODES]
+
+
+def get_tx_trace_stats(debug_trace: dict, ngram_size: int = 0, contract: Union[str, None] = None, call_frames: bool = False) -> Dict[TraceDataType, dict]:
+    """Parses the debug trace obtained from debug_traceTransaction calls in a single pass and
+    returns the opcode counts, the gas spent by each opcode (a list in the order of the opcode counts) and, if ngram_size > 1,
+    the counts of the opcode n-grams of size 2..ngram_size.
+
+    If contract (the tx `to` address) is given, the opcode counts per contract are returned as well.
+    Without call_frames all opcodes are attributed to contract; with call_frames (the trace must contain the stack)
+    the opcodes of each call frame are attributed to the callee of the CALL opcode that opened it.
+
+    The gas of an opcode is the drop in remaining gas until the next opcode of the same call frame.
+    For opcodes that open a new call frame (CALL, CREATE, ...) the gas consumed inside the callee
+    is subtracted, since it is already attributed to the callee's own opcodes; the last opcode
+    of a frame falls back to the reported gasCost.
+
+    N-grams are built from a rolling code of the last ngram_size opcodes and do not cross call frames:
+    the caller's window is saved when a call frame is entered and restored when it returns, so sequences
+    such as `CALL ISZERO` are counted. The exact n-gram counts are grouped by size ({n: {ngram: count}}),
+    the n-grams being the opcode names joined by spaces.
+    """
+
     opcodes: Dict[str, int] = dict()
+    opcodes_gas: Dict[str, int] = dict()
+    ngram_codes: List[Dict[int, int]] = [dict() for _ in range(ngram_size + 1)]
+    ngram_masks = [(1 << (OPCODE_BITS * n)) - 1 for n in range(ngram_size + 1)]
+    window = 0
+    window_len = 0
+    window_depth = None
+    # (window, window_len) of the callers of the current call frame
+    window_frames: List[Tuple[int, int]] = []
+
+    # (opcode, gas before the opcode, total attributed gas before entering the callee) for each open call frame
+    open_calls: List[Tuple[str, int, int]] = []
+    total_gas = 0
+    prev_log = None
+
+    contract_opcodes: Dict[str, Dict[str, int]] = dict()
+    frame_contracts = [contract]
+
     for log in debug_trace.get('structLogs'):
         op_code = log.get('op')
+        depth = log.get('depth')
         if op_code in opcodes:
             opcodes[op_code] = opcodes[op_code] + 1
         else:
             opcodes[op_code] = 1
 
-    return opcodes
+        if prev_log:
+            prev_op_code = prev_log.get('op')
+            prev_depth = prev_log.get('depth')
+            if depth > prev_depth:
+                open_calls.append((prev_op_code, prev_log.get('gas'), total_gas))
+            else:
+                gas = prev_log.get('gas') - log.get('gas') if depth == prev_depth else prev_log.get('gasCost')
+                opcodes_gas[prev_op_code] = opcodes_gas.get(prev_op_code, 0) + gas
+                total_gas += gas
+
+                while open_calls and len(open_calls) >= depth:
+                    call_op_code, call_gas, total_gas_at_call = open_calls.pop()
+                    gas = call_gas - log.get('gas') - (total_gas - total_gas_at_call)
+                    opcodes_gas[call_op_code] = opcodes_gas.get(call_op_code, 0) + gas
+                    total_gas += gas
+
+            if contract and call_frames:
+                if depth > prev_depth:
+                    frame_contracts.append(get_callee(prev_log))
+                while len(frame_contracts) > max(depth, 1):
+                    frame_contracts.pop()
+
+        prev_log = log
+
+        if contract:
+            frame_opcodes = contract_opcodes.setdefault(frame_contracts[-1], dict())
+            frame_opcodes[op_code] = frame_opcodes.get(op_code, 0) + 1
+
+        if ngram_size < 2:
+            continue
+
+        if window_depth is None:
+            window_depth = depth
+        elif depth > window_depth:
+            window_frames.append((window, window_len))
+            window_frames.extend([(0, 0)] * (depth - window_depth - 1))
+            window = 0
+            window_len = 0
+            window_depth = depth
+        elif depth < window_depth:
+            while window_frames and window_depth > depth:
+                window, window_len = window_frames.pop()
+                window_depth -= 1
+            window_depth = depth
+
+        window = ((window << OPCODE_BITS) | encode_opcode(op_code)) & ngram_masks[ngram_size]
+        window_len += 1
+
+        for n in range(2, min(window_len, ngram_size) + 1):
+            code = window & ngram_masks[n]
+            counts = ngram_codes[n]
+            counts[code] = counts.get(code, 0) + 1
+
+    if prev_log:
+        opcodes_gas[prev_log.get('op')] = opcodes_gas.get(prev_log.get('op'), 0) + prev_log.get('gasCost')
+
+    # The gas is stored as a list aligned with the opcodes, so the opcode names are not repeated.
+    tx_stats: Dict[TraceDataType, Union[Dict[str, int], List[int]]] = {TraceDataType.OPCODES: opcodes, TraceDataType.OPCODE_GAS: [opcodes_gas.get(op_code, 0) for op_code in opcodes]}
+
+    if ngram_size > 1:
+        tx_stats[TraceDataType.OPCODE_NGRAMS] = {n: {decode_ngram(code, n): count for code, count in ngram_codes[n].items()} for n in range(2, ngram_size + 1)}
+
+    if contract:
+        tx_stats[TraceDataType.CONTRACT_OPCODES] = contract_opcodes
+
+    return tx_stats
+
+
+def get_callee(call_log: dict) -> str:
+    """Return the address of the contract whose code runs in the frame opened by call_log."""
+
+    stack = call_log.get('stack')
+    if call_log.get('op') not in CALL_OPCODES or not stack or len(stack) < 2:
+        return CONTRACT_CREATION
+
+    return '0x{:040x}'.format(int(stack[-2], 16) & ((1 << 160) - 1))
+
+
+def encode_opcode(op_code: str) -> int:
+    """Return the small integer code of the opcode, assigning a new one the first time the opcode is seen.
+    Raises a ValueError once more distinct opcode names are seen than fit in OPCODE_BITS."""
+
+    code = _opcode_codes.get(op_code)
+    if code is None:
+        code = len(_opcode_names)
+        if code >= 1 << OPCODE_BITS:
+            raise ValueError(f"Can't encode opcode {op_code}: more than {1 << OPCODE_BITS} distinct opcode names seen.")
+        _opcode_codes[op_code] = code
+        _opcode_names.append(op_code)
+
+    return code
+
+
+def decode_ngram(code: int, n: int) -> str:
+    """Return the opcode names (joined by spaces, oldest first) packed into the rolling code of an n-gram."""
 
+    op_codes = []
+    mask = (1 << OPCODE_BITS) - 1
+    for _ in range(n):
+        op_codes.append(_opcode_names[code & mask])
+        code >>= OPCODE_BITS
 
+    return " ".join(reversed(op_codes))
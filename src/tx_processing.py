@@ -1,27 +1,49 @@
 import aiohttp
 import asyncio
-from api.eth_requests import get_block_async, get_tx_receipt_async
+from api.eth_requests import get_block_async, get_block_receipts_async
 from typing import Dict, Union, Tuple, List
+from .utils import CONTRACT_CREATION
 
 
-async def get_block_txs(session: aiohttp.ClientSession, start_block: int, end_block: int):
+async def get_block_txs(session: aiohttp.ClientSession, start_block: int, end_block: int, use_block_receipts: bool = True) -> Tuple[Dict[int, List[str]], Dict[str, str]]:
+    """Return the filtered tx hashes of each block in [start_block, end_block)
+    and the `to` address of each of those txs. The blocks are fetched and filtered concurrently."""
 
-    blocks_data = await asyncio.gather(*[get_block_async(session, block_number, True) for block_number in range(start_block, end_block)])
+    blocks_txs = await asyncio.gather(*[get_block_tx_hashes(session, block_number, use_block_receipts) for block_number in range(start_block, end_block)])
 
     filtered_tx_hashes_per_block = dict()
+    tx_contracts = dict()
 
-    for block_data in blocks_data:
-        if not block_data:
+    for block_txs in blocks_txs:
+        if not block_txs:
             continue
 
-        filtered_tx_hashes = get_filtered_tx_hashes(block_data.get('transactions'))
-        tx_receipts = await asyncio.gather(*[get_tx_receipt_async(session, tx_hash) for tx_hash in filtered_tx_hashes])
-
-        filtered_tx_hashes = filter_tx_receipts(tx_receipts)
-        block_number = int(block_data.get('number'), 16)
+        block_number, filtered_tx_hashes, block_tx_contracts = block_txs
         filtered_tx_hashes_per_block[block_number] = filtered_tx_hashes
+        tx_contracts.update(block_tx_contracts)
+
+    return filtered_tx_hashes_per_block, tx_contracts
+
+
+async def get_block_tx_hashes(session: aiohttp.ClientSession, block_number: int, use_block_receipts: bool = True) -> Union[Tuple[int, List[str], Dict[str, str]], None]:
+    """Fetch a block and return its number, its filtered tx hashes and their `to` addresses.
+    Failed txs are dropped using the block receipts (fetched alongside the block, so the whole
+    block costs a single round trip). If the node does not support eth_getBlockReceipts the failed
+    txs are kept here and dropped later from the `failed` flag of their traces."""
+
+    if use_block_receipts:
+        block_data, block_receipts = await asyncio.gather(get_block_async(session, block_number, True), get_block_receipts_async(session, block_number))
+    else:
+        block_data, block_receipts = await get_block_async(session, block_number, True), None
+
+    if not block_data:
+        return None
 
-    return filtered_tx_hashes_per_block
+    filtered_tx_hashes = get_filtered_tx_hashes(block_data.get('transactions'))
+    if block_receipts:
+        filtered_tx_hashes = filter_failed_tx_hashes(filtered_tx_hashes, block_receipts)
+
+    return int(block_data.get('number'), 16), filtered_tx_hashes, get_tx_contracts(block_data.get('transactions'), filtered_tx_hashes)
 
 
 def get_filtered_tx_hashes(full_txs: List[Dict]) -> List[str]:
@@ -35,12 +57,17 @@ def get_filtered_tx_hashes(full_txs: List[Dict]) -> List[str]:
     return filtered_tx_hashes
 
 
-def filter_tx_receipts(tx_receipts: List[Dict]) -> List[str]:
-    filtered_tx_hashes = []
-    for tx_receipt in tx_receipts:
-        if tx_receipt.get('status') == '0x0':
-            continue
+def get_tx_contracts(full_txs: List[Dict], tx_hashes: List[str]) -> Dict[str, str]:
+    tx_hashes = set(tx_hashes)
+    tx_contracts = dict()
+    for tx in full_txs:
+        if tx.get('hash') in tx_hashes:
+            tx_contracts[tx.get('hash')] = tx.get('to') or CONTRACT_CREATION
+
+    return tx_contracts
+
 
-        filtered_tx_hashes.append(tx_receipt.get('transactionHash'))
+def filter_failed_tx_hashes(tx_hashes: List[str], tx_receipts: List[Dict]) -> List[str]:
+    failed_tx_hashes = {tx_receipt.get('transactionHash') for tx_receipt in tx_receipts if tx_receipt.get('status') == '0x0'}
 
-    return filtered_tx_hashes
\ No newline at end of file
+    return [tx_hash for tx_hash in tx_hashes if tx_hash not in failed_tx_hashes]
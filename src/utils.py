@@ -6,4 +6,29 @@ class StatsType(str, Enum):
     TOTAL_AMOUNT_OPCODES = 'TOTAL_AMOUNT_OPCODES'
     OPCODE_COUNTS = 'OPCODE_COUNTS'
     OPCODE_STATS = 'OPCODE_STATS'
-    OPCODE_BLOCK_FREQUENCY = 'OPCODE_BLOCK_FREQUENCY'
\ No newline at end of file
+    OPCODE_BLOCK_FREQUENCY = 'OPCODE_BLOCK_FREQUENCY'
+    OPCODE_NGRAMS = 'OPCODE_NGRAMS'
+    OPCODE_GAS = 'OPCODE_GAS'
+    OPCODE_GAS_STATS = 'OPCODE_GAS_STATS'
+    CONTRACT_PROFILES = 'CONTRACT_PROFILES'
+
+
+class TraceDataType(str, Enum):
+    OPCODES = 'OPCODES'
+    OPCODE_NGRAMS = 'OPCODE_NGRAMS'
+    OPCODE_GAS = 'OPCODE_GAS'
+    CONTRACT_OPCODES = 'CONTRACT_OPCODES'
+
+
+# Base file names (without the .json/.jsonl extension) of the per tx trace data in a window dir.
+# The opcode gas of a tx is a list aligned with the order of its opcodes in the opcode stats file.
+TRACE_DATA_FILES = {
+    TraceDataType.OPCODES: 'tx_opcode_stats',
+    TraceDataType.OPCODE_NGRAMS: 'tx_opcode_ngrams',
+    TraceDataType.OPCODE_GAS: 'tx_opcode_gas',
+    TraceDataType.CONTRACT_OPCODES: 'tx_contract_opcodes',
+}
+
+
+# Stands in for the `to` address of contract creation txs and the callee of CREATE/CREATE2 frames.
+CONTRACT_CREATION = 'CREATE'
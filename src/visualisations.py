@@ -8,6 +8,7 @@ from json2html import json2html
 
 from typing import Dict, Tuple
 from .utils import StatsType
+from .stats import get_top_contracts
 
 
 def frequencies_chart(chart_name: str, data: dict, y_label: str, x_label: str, title: str, label: str):
@@ -36,7 +37,7 @@ def frequencies_chart(chart_name: str, data: dict, y_label: str, x_label: str, t
     fig.savefig(f"charts/{chart_name}.png")
 
 
-def opcode_count_chart(chart_name: str, opcode_counts: Dict[str, int]):
+def opcode_count_chart(chart_name: str, opcode_counts: Dict[str, int], label: str = 'Opcode counts'):
 
     opcodes = list(opcode_counts.keys())
     counts = list(opcode_counts.values())
@@ -45,7 +46,7 @@ def opcode_count_chart(chart_name: str, opcode_counts: Dict[str, int]):
     plt.style.use('fivethirtyeight')
 
     fig, ax = plt.subplots()
-    ax.barh(opcodes, counts, label='Opcode counts')
+    ax.barh(opcodes, counts, label=label)
     ax.legend()
 
     plt.show()
@@ -108,6 +109,20 @@ def make_visualisations(blocks_stats: Dict[Tuple[int, int], Dict[StatsType, dict
             elif stats_type == StatsType.OPCODE_BLOCK_FREQUENCY:
                 name = f"opcode_frequencies_{start_block}_{end_block}"
                 opcode_frequencies_chart_seaborn(name, stats, start_block, end_block)
+            elif stats_type == StatsType.OPCODE_NGRAMS:
+                for n, ngram_counts in stats.items():
+                    name = f"opcode_{n}grams_{start_block}_{end_block}"
+                    opcode_count_chart(name, ngram_counts, f"Opcode {n}-gram counts")
+                    create_opcode_ngrams_md_table(name, ngram_counts, n)
+            elif stats_type == StatsType.OPCODE_GAS:
+                name = f"opcode_gas_{start_block}_{end_block}"
+                opcode_count_chart(name, stats, 'Opcode gas')
+            elif stats_type == StatsType.OPCODE_GAS_STATS:
+                name = f"opcode_gas_stats_{start_block}_{end_block}"
+                create_opcode_gas_stats_md_table(name, stats, start_block, end_block)
+            elif stats_type == StatsType.CONTRACT_PROFILES:
+                name = f"contract_storage_{start_block}_{end_block}"
+                create_contract_opcodes_md_table(name, stats, ['SLOAD', 'SSTORE'], start_block, end_block)
 
 
 def sstats(opcode_counts):
@@ -136,6 +151,18 @@ def create_opcode_counts_md_table(table_name: str, data: dict):
         f.write(table)
 
 
+def create_opcode_ngrams_md_table(table_name: str, data: dict, n: int):
+
+    table_rows = [f"| OPCODE {n}-GRAM      | Count |", "| ----------- | ----------- |"]
+    for key, value in data.items():
+        table_rows.append(f"| {key} | {value} |")
+
+    table = "\n".join(table_rows)
+
+    with open(f"./tables/{table_name}.md", "w") as f:
+        f.write(table)
+
+
 def create_opcode_stats_md_table(table_name: str, data: dict, start_block: int, end_block: int):
 
     table_rows = ["| OPCODE      | Frequency | Frequency percent | Count | Average count per block |", "| ----------- | ----------- | ----------- | ----------- | ----------- |"]
@@ -163,3 +190,51 @@ def create_opcode_stats_md_table(table_name: str, data: dict, start_block: int,
     with open(f"./tables/{table_name}.md", "w") as f:
         f.write(stats_text)
 
+
+def create_opcode_gas_stats_md_table(table_name: str, data: dict, start_block: int, end_block: int):
+
+    table_rows = ["| OPCODE      | Gas | Gas percent | Count | Average gas |", "| ----------- | ----------- | ----------- | ----------- | ----------- |"]
+    for key, stats in data.items():
+        table_rows.append(f"| **{key}** | {stats['gas']} | {stats['gas_percent']}% | {stats['count']} | {stats['avg_gas']} |")
+
+    table = "\n".join(table_rows)
+    num_blocks = end_block - start_block
+    stats_text = f"""
+
+### Opcode gas stats for blocks: **{start_block}** - **{end_block}** ({num_blocks} blocks)
+
+
+#### Legend:
+* **Gas** - Total gas spent executing the OPCODE (gas used inside calls is attributed to the callee's opcodes)
+* **Gas percent** - % of the total execution gas spent on the OPCODE
+* **Count** - how many times in total the OPCODE appeared
+* **Average gas** - Gas/Count
+    
+*Note: the table is sorted by the Gas field*
+
+{table}    
+    """
+
+    with open(f"./tables/{table_name}.md", "w") as f:
+        f.write(stats_text)
+
+
+def create_contract_opcodes_md_table(table_name: str, data: dict, opcodes: list, start_block: int, end_block: int, n: int = 10):
+
+    tables = []
+    for opcode in opcodes:
+        table_rows = [f"#### {opcode}", "", "| CONTRACT      | Count | Tx count |", "| ----------- | ----------- | ----------- |"]
+        for contract, count in get_top_contracts(data, opcode, n):
+            table_rows.append(f"| {contract} | {count} | {data['contracts'][contract]['tx_count']} |")
+        tables.append("\n".join(table_rows))
+
+    table = "\n\n".join(tables)
+    stats_text = f"""
+
+### Top {n} contracts by opcode for blocks: **{start_block}** - **{end_block}**
+
+{table}
+    """
+
+    with open(f"./tables/{table_name}.md", "w") as f:
+        f.write(stats_text)